@@ -1,28 +1,44 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 
+import asyncio
+import hashlib
 import os
 import logging
+import shutil
 import signal
-import subprocess
+import string
 import sys
-import threading
-import time
-import Queue
+import tempfile
+from dataclasses import dataclass
+from typing import Optional
 
 logging.basicConfig(level=logging.DEBUG,
                     format="%(asctime)s:autotls:%(message)s")
 
 # Based on https://mozilla.github.io/server-side-tls/ssl-config-generator/
-# for Nginx 1.11.3
+TLS_CIPHERS = (
+    "ECDHE-ECDSA-CHACHA20-POLY1305:ECDHE-RSA-CHACHA20-POLY1305:"
+    "ECDHE-ECDSA-AES128-GCM-SHA256:ECDHE-RSA-AES128-GCM-SHA256:"
+    "ECDHE-ECDSA-AES256-GCM-SHA384:ECDHE-RSA-AES256-GCM-SHA384:"
+    "DHE-RSA-AES128-GCM-SHA256:DHE-RSA-AES256-GCM-SHA384:"
+    "ECDHE-ECDSA-AES128-SHA256:ECDHE-RSA-AES128-SHA256:"
+    "ECDHE-ECDSA-AES128-SHA:ECDHE-RSA-AES256-SHA384:ECDHE-RSA-AES128-SHA:"
+    "ECDHE-ECDSA-AES256-SHA384:ECDHE-ECDSA-AES256-SHA:ECDHE-RSA-AES256-SHA:"
+    "DHE-RSA-AES128-SHA256:DHE-RSA-AES128-SHA:DHE-RSA-AES256-SHA256:"
+    "DHE-RSA-AES256-SHA:ECDHE-ECDSA-DES-CBC3-SHA:ECDHE-RSA-DES-CBC3-SHA:"
+    "EDH-RSA-DES-CBC3-SHA:AES128-GCM-SHA256:AES256-GCM-SHA384:"
+    "AES128-SHA256:AES256-SHA256:AES128-SHA:AES256-SHA:DES-CBC3-SHA:!DSS"
+)
+
 TLS_CONFIG = """
-server {{
-    server_name {0};
+server {
+    server_name $domain;
     listen 443 ssl http2;
     # listen [::]:443 ssl http2;
 
-    ssl_certificate {1};
-    ssl_certificate_key {2};
-    ssl_ciphers 'ECDHE-ECDSA-CHACHA20-POLY1305:ECDHE-RSA-CHACHA20-POLY1305:ECDHE-ECDSA-AES128-GCM-SHA256:ECDHE-RSA-AES128-GCM-SHA256:ECDHE-ECDSA-AES256-GCM-SHA384:ECDHE-RSA-AES256-GCM-SHA384:DHE-RSA-AES128-GCM-SHA256:DHE-RSA-AES256-GCM-SHA384:ECDHE-ECDSA-AES128-SHA256:ECDHE-RSA-AES128-SHA256:ECDHE-ECDSA-AES128-SHA:ECDHE-RSA-AES256-SHA384:ECDHE-RSA-AES128-SHA:ECDHE-ECDSA-AES256-SHA384:ECDHE-ECDSA-AES256-SHA:ECDHE-RSA-AES256-SHA:DHE-RSA-AES128-SHA256:DHE-RSA-AES128-SHA:DHE-RSA-AES256-SHA256:DHE-RSA-AES256-SHA:ECDHE-ECDSA-DES-CBC3-SHA:ECDHE-RSA-DES-CBC3-SHA:EDH-RSA-DES-CBC3-SHA:AES128-GCM-SHA256:AES256-GCM-SHA384:AES128-SHA256:AES256-SHA256:AES128-SHA:AES256-SHA:DES-CBC3-SHA:!DSS';
+    ssl_certificate $full_chain;
+    ssl_certificate_key $private_key;
+    ssl_ciphers '$ciphers';
     ssl_dhparam /etc/ssl/certs/dhparam.pem;
     ssl_prefer_server_ciphers on;
     ssl_protocols TLSv1 TLSv1.1 TLSv1.2;
@@ -31,7 +47,7 @@ server {{
     ssl_session_tickets off;
     ssl_stapling on;
     ssl_stapling_verify on;
-    ssl_trusted_certificate {3};
+    ssl_trusted_certificate $chain;
 
     # HSTS (ngx_http_headers_module is required) (15768000 seconds = 6 months)
     add_header Strict-Transport-Security max-age=15768000;
@@ -48,11 +64,49 @@ server {{
     #
     # Note: adding duplicates to the directives defined
     # above will cause errors. This sucks....
-    {4}
-}}
+    $custom_include
+}
 """
 
 
+def split_template(template, **constants):
+    """
+    Split a string.Template into its static chunks and the names of the
+    placeholders between them, following the Template rules: $$ is a
+    literal $, $name and ${name} are placeholders. Placeholders given in
+    constants are filled in right away.
+
+    :type template: string.Template
+    :return: (list of bytes, list of string), one chunk more than names
+    """
+    chunks, fields, literal, pos = [], [], [], 0
+    for match in template.pattern.finditer(template.template):
+        literal.append(template.template[pos:match.start()])
+        pos = match.end()
+        if match.group("escaped") is not None:
+            literal.append(template.delimiter)
+            continue
+        name = match.group("named") or match.group("braced")
+        if name is None:
+            raise ValueError(
+                f"invalid placeholder in template at {match.start()}")
+        if name in constants:
+            literal.append(constants[name])
+            continue
+        chunks.append("".join(literal).encode())
+        fields.append(name)
+        literal = []
+    literal.append(template.template[pos:])
+    chunks.append("".join(literal).encode())
+    return chunks, fields
+
+
+# The static parts of TLS_CONFIG, split around its placeholders once at
+# import: rendering a virtual host only has to join bytes.
+TLS_CHUNKS, TLS_FIELDS = split_template(
+    string.Template(TLS_CONFIG), ciphers=TLS_CIPHERS)
+
+
 PROXY_CONFIG = """
 server {
     listen 443 ssl;
@@ -73,138 +127,196 @@ PRIVATE_KEY = "privkey.pem"
 
 CHAIN = "chain.pem"
 
-NGINX_CMD = ["/usr/sbin/nginx", "-g", "daemon off;"]
+# resolved once, so starting a process does not search PATH again
+NGINX_BIN = shutil.which("nginx") or "/usr/sbin/nginx"
+
+CERTBOT_BIN = shutil.which("certbot") or "certbot"
+
+NGINX_CMD = [NGINX_BIN, "-g", "daemon off;"]
 
 # NOTE: Send 1 for reload and send 3 for stop.
 # SIGHUP        1       Term    Hangup detected on controlling terminal
 # SIGQUIT       3       Core    Quit from keyboard
-NGINX_RENEW_CMD = (
-    """certbot renew --preferred-challenges http-01 """
-    """--standalone --must-staple --agree-tos --quiet """
-    """--pre-hook 'kill -1 `cat /var/run/nginx.pid`; sleep 2' """
-    """--post-hook 'kill -3 `cat /var/run/nginx.pid`; sleep 2' """
-)
+NGINX_RENEW_CMD = [
+    CERTBOT_BIN, "renew", "--preferred-challenges", "http-01",
+    "--standalone", "--must-staple", "--agree-tos", "--quiet",
+    "--pre-hook", "kill -1 `cat /var/run/nginx.pid`; sleep 2",
+    "--post-hook", "kill -3 `cat /var/run/nginx.pid`; sleep 2",
+]
 
-NGINX_FORCE_RENEW_CMD = NGINX_RENEW_CMD + "--force-renewal"
+NGINX_FORCE_RENEW_CMD = NGINX_RENEW_CMD + ["--force-renewal"]
 
+# seconds between two renewal attempts
+RENEW_INTERVAL = 3600
 
-class Config(object):
+# seconds a child gets to exit on SIGTERM before it is killed
+KILL_GRACE_PERIOD = 1
 
-    defaults = {
-        'debug': False,
-        'domain': None,
-        'email': None,
-        'server': None,
-        'staging': False,
-    }
 
-    def __init__(self):
-        for k, v in Config.defaults.iteritems():
-            setattr(self, k, v)
+@dataclass(frozen=True, slots=True)
+class Config:
+    """
+    Immutable container configuration, built once from the environment.
+    """
+    domain: str
+    email: str
+    server: Optional[str] = None
+    staging: bool = False
+    debug: bool = False
 
-    def set(self, key, value):
-        setattr(self, key, value)
 
-    def get(self, key, default=None):
-        if hasattr(self, key):
-            return self.__getattribute__(key)
-        return default
+class Process(object):
+    """
+    Keeps track of the child processes we start, so that whatever is still
+    running can be killed on the way out. A process is held here, mapped to
+    the task waiting for it, until it has been reaped, even if the caller
+    dropped its handle.
+    """
+    processes = {}
+
+    @classmethod
+    async def start(cls, cmd, **kwargs):
+        # our own descriptors are non-inheritable, so there is nothing for
+        # close_fds to do. each child gets its own process group.
+        handle = await asyncio.create_subprocess_exec(
+            *cmd, close_fds=False, start_new_session=True, **kwargs)
+        waiter = asyncio.ensure_future(handle.wait())
+        waiter.add_done_callback(lambda _: cls._reaped(handle))
+        cls.processes[handle] = waiter
+        return handle
+
+    @classmethod
+    def _reaped(cls, handle):
+        # the waiter is also cancelled when asyncio.run shuts down, keep
+        # the process around for kill_all if it has not exited yet
+        if handle.returncode is not None:
+            cls.processes.pop(handle, None)
+
+    @classmethod
+    async def kill_all(cls):
+        """
+        Terminate the process group of every child that is still running,
+        give them KILL_GRACE_PERIOD seconds to exit and kill the rest.
+        :return: None
+        """
+        running = [p for p in list(cls.processes) if p.returncode is None]
+        if not running:
+            return
+        for p in running:
+            cls._killpg(p, signal.SIGTERM)
+        waiters = [asyncio.create_task(p.wait()) for p in running]
+        _, pending = await asyncio.wait(waiters, timeout=KILL_GRACE_PERIOD)
+        if pending:
+            for p in running:
+                if p.returncode is None:
+                    cls._killpg(p, signal.SIGKILL)
+            await asyncio.wait(pending)
+
+    @staticmethod
+    def _killpg(proc, sig):
+        # every child leads its own process group, see start()
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
 
 
 class Certbot(object):
-    done_lock = threading.Lock()
+    done = asyncio.Event()
 
     def __init__(self, config):
-        self.args = dict()
         self.config = config
-        self.domain = self.config.get("domain")
-        self.email = self.config.get("email")
-        self.cmd = ["certbot", "certonly"]
-
-        self.add_arg("--domain", self.domain)
-        self.add_arg("--email", self.email)
-        self.add_arg("--standalone")
-        self.add_arg("--non-interactive")
-        self.add_arg("--agree-tos")
-        self.add_arg("--must-staple")
-
-        if self.config.get("staging"):
-            self.add_arg("--staging")
-        # if self.config.get("debug"):
-        #     self.add_arg("-vvv", "--text")
-        if self.config.get("server"):
-            self.add_arg("--server", self.config.get("server"))
+        self.domain = self.config.domain
+        self.email = self.config.email
+        self.cmd = [
+            CERTBOT_BIN, "certonly",
+            "--domain", self.domain,
+            "--email", self.email,
+            "--standalone",
+            "--non-interactive",
+            "--agree-tos",
+            "--must-staple",
+        ]
+
+        if self.config.staging:
+            self.cmd.append("--staging")
+        # if self.config.debug:
+        #     self.cmd.extend(("-vvv", "--text"))
+        if self.config.server:
+            self.cmd.extend(("--server", self.config.server))
 
         # We must use HTTP-01 - as we will be using TLS-SNI raw packet routing
         # in front of this and TLS-SNI based challenges use the reserved name
         # acme.invalid
-        self.add_arg("--preferred-challenges", "http-01")
-
-    def add_arg(self, key, value=None):
-        self.args[key] = value
+        self.cmd.extend(("--preferred-challenges", "http-01"))
 
-    def run(self):
+    async def run(self):
         """
-        Build the certbot command array using self.args
+        Run the certbot command built in __init__
         :return: None
         """
-        for k, v in self.args.iteritems():
-            self.cmd.append(k)
-            if v is not None:
-                self.cmd.append(v)
-
-        logging.info("obtaining certificates for {}".format(self.domain))
-        try:
-            subprocess.check_call(self.cmd)
-        except subprocess.CalledProcessError:
+        logging.info(f"obtaining certificates for {self.domain}")
+        proc = await Process.start(self.cmd)
+        if await proc.wait() != 0:
             # ouch, these should be handled better.
             fail_with_error_message(
-                "Command failed: {}".format(" ".join(self.cmd)))
+                f"Command failed: {' '.join(self.cmd)}")
 
 
 class Nginx(object):
     _handle = None
-    _running = False
+    started = asyncio.Event()
     _exiting = False
     config_path = "/etc/nginx/conf.d/reverse_proxy.conf"
-    _lock = threading.Lock()
+    _lock = asyncio.Lock()
 
     @classmethod
-    def disallow_start(cls):
-        cls._lock.acquire()
+    async def disallow_start(cls):
+        await cls._lock.acquire()
 
     @classmethod
     def allow_start(cls):
         cls._lock.release()
 
     @classmethod
-    def is_running(cls):
-        return cls._running
-
-    @classmethod
-    def run_forever(cls):
-        while 1:
+    async def run_forever(cls):
+        while not cls._exiting:
             if cls._handle is None:
-                cls._start()
+                await cls._start()
+                if cls._handle is None:
+                    # we were asked to exit while waiting to start
+                    break
+            handle = cls._handle
             try:
-                cls._handle.wait()
-            except KeyboardInterrupt:
-                cls.stop()
+                await handle.wait()
+            except asyncio.CancelledError:
+                # only reached when a task raises SystemExit through
+                # fail_with_error_message and asyncio.run cancels every
+                # task. let nginx drain before main cleans up
+                cls.exit()
+                try:
+                    await asyncio.wait_for(handle.wait(), KILL_GRACE_PERIOD)
+                except asyncio.TimeoutError:
+                    pass
                 logging.info("goodbye")
                 break
-            cls._running = False
+            cls.started.clear()
             cls._handle = None
             logging.debug('nginx process has been stopped')
-            if cls._exiting:
-                break
 
     @classmethod
-    def _start(cls):
-        cls._lock.acquire()
-        logging.info('starting nginx')
-        cls._handle = subprocess.Popen(NGINX_CMD)
-        cls._running = True
-        cls._lock.release()
+    async def _start(cls):
+        async with cls._lock:
+            if cls._exiting:
+                return
+            logging.info('starting nginx')
+            cls._handle = await Process.start(NGINX_CMD)
+            cls.started.set()
+            if cls._exiting:
+                # exit was requested while nginx was being spawned, and
+                # Nginx.exit had no handle to signal yet
+                logging.info("stopping nginx")
+                cls._handle.send_signal(signal.SIGQUIT)
 
     @classmethod
     def reload(cls):
@@ -214,7 +326,7 @@ class Nginx(object):
     @classmethod
     def stop(cls):
         logging.info("stopping nginx")
-        if cls._handle and cls._handle.poll() is None:
+        if cls._handle and cls._handle.returncode is None:
             cls._handle.send_signal(signal.SIGQUIT)
         cls._handle = None
 
@@ -227,28 +339,53 @@ class Nginx(object):
 
     @classmethod
     def remove_proxy_config(cls):
+        """
+        :return: bool, True if there was a proxy config to remove
+        """
         if os.path.exists(cls.config_path):
             os.remove(cls.config_path)
+            return True
+        return False
 
     @classmethod
     def write_proxy_config(cls):
-        with open(cls.config_path, "w") as fo:
-            fo.write(PROXY_CONFIG)
+        atomic_write(cls.config_path, PROXY_CONFIG.encode())
 
 
-def certs_exist(domain):
+def certs_missing(domain):
     """
-    The existence of the full chain certificate is the indication of whether
-    we try to obtain certificates for Let's Encrypt.
+    The absence of the full chain certificate is the indication that we
+    have to obtain certificates from Let's Encrypt.
 
     :param domain string
     :return: bool
     """
-    return not os.path.exists(live_dir_path(domain, FULL_CHAIN))
+    # the live files are symlinks into archive/, is_file() follows them so
+    # a dangling link does not count
+    return not dir_has_entry(
+        live_dir(domain),
+        lambda entry: entry.name == FULL_CHAIN and entry.is_file())
+
+
+def dir_has_entry(path, predicate):
+    """
+    Read a directory once and check whether any of its entries match.
+    A missing directory, or a path that is not a directory, has no entries.
+
+    :param path: string
+    :param predicate: callable taking an os.DirEntry
+    :return: bool
+    """
+    try:
+        with os.scandir(path) as entries:
+            return any(predicate(entry) for entry in entries)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
 
 
-def live_dir_path(domain, path):
-    return os.path.join(LE_BASE_DIR, domain, path)
+def live_dir(domain):
+    # LE_BASE_DIR is absolute and the domain is a single path component
+    return f"{LE_BASE_DIR}/{domain}"
 
 
 def create_nginx_config_file(domain):
@@ -258,32 +395,151 @@ def create_nginx_config_file(domain):
     :idea use an nginx parser - or have a different way of creating the nginx
     config, this is very inflexible. would the cerbot nginx plugin be useful?
     :param domain:
-    :return:
+    :return: bool, False if the existing config file was left untouched
     """
     custom_include = ""
-    if os.path.exists("/etc/nginx/conf.d/custom/"):
+    if dir_has_entry("/etc/nginx/conf.d/custom/",
+                     lambda entry: entry.name.endswith(".conf")):
         logging.info("Including custom configuration")
         custom_include = "include /etc/nginx/conf.d/custom/*.conf;"
 
     fp = os.path.join("/etc/nginx/conf.d", domain + ".conf")
-    with open(fp, "w") as fd:
-        fd.write(TLS_CONFIG.format(
-            domain,
-            live_dir_path(domain, FULL_CHAIN),
-            live_dir_path(domain, PRIVATE_KEY),
-            live_dir_path(domain, CHAIN),
-            custom_include))
-    logging.info(
-        "virtual host created for {}".format(domain))
+    config_hash = nginx_config_hash(domain, custom_include)
+    if os.path.exists(fp) and read_config_hash(fp) == config_hash:
+        logging.info(f"virtual host for {domain} is up to date")
+        return False
+
+    base = live_dir(domain)
+    atomic_write(fp, render_tls_config(
+        domain=domain,
+        full_chain=f"{base}/{FULL_CHAIN}",
+        private_key=f"{base}/{PRIVATE_KEY}",
+        chain=f"{base}/{CHAIN}",
+        custom_include=custom_include))
+    write_config_hash(fp, config_hash)
+    logging.info(f"virtual host created for {domain}")
+    return True
+
+
+def render_tls_config(**values):
+    """
+    Fill the TLS_CONFIG placeholders by joining the precomputed chunks.
+
+    :return: bytes
+    """
+    parts = [TLS_CHUNKS[0]]
+    for field, chunk in zip(TLS_FIELDS, TLS_CHUNKS[1:]):
+        parts.append(values[field].encode())
+        parts.append(chunk)
+    return b"".join(parts)
+
+
+def install_tls_config(domain):
+    """
+    Swap the proxy config for the TLS virtual host in one step. Nginx only
+    needs a single reload afterwards.
+
+    :param domain:
+    :return: bool, True if nginx has to be reloaded
+    """
+    changed = create_nginx_config_file(domain)
+    return Nginx.remove_proxy_config() or changed
+
+
+def nginx_config_hash(domain, custom_include):
+    """
+    Everything the generated virtual host depends on, the template and
+    cipher list included: if none of it has changed since the config was
+    written there is no need to rewrite it.
+
+    :param domain:
+    :param custom_include:
+    :return: string
+    """
+    base = live_dir(domain)
+    mtimes = []
+    for path in (FULL_CHAIN, PRIVATE_KEY, CHAIN):
+        try:
+            mtimes.append(os.stat(f"{base}/{path}").st_mtime_ns)
+        except OSError:
+            mtimes.append(None)
+    return hashlib.sha256(
+        repr((TLS_CONFIG, TLS_CIPHERS, domain, mtimes, custom_include))
+        .encode()).hexdigest()
+
+
+def read_config_hash(config_path):
+    try:
+        with open(config_path + ".hash") as fd:
+            return fd.read().strip()
+    except OSError:
+        return None
+
+
+def write_config_hash(config_path, config_hash):
+    atomic_write(config_path + ".hash", config_hash.encode())
+
+
+def atomic_write(path, data):
+    """
+    Install a file so that nginx never reads a partially written one.
+
+    The data is written to an anonymous O_TMPFILE in the target directory,
+    linked next to the target once complete and renamed over it. Without
+    O_TMPFILE support a named temporary file is used instead.
+
+    :param path: string
+    :param data: bytes
+    :return: None
+    """
+    dirname, name = os.path.split(path)
+    dir_fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        fd = os.open(".", os.O_TMPFILE | os.O_WRONLY, 0o644, dir_fd=dir_fd)
+    except (AttributeError, OSError):
+        os.close(dir_fd)
+        with tempfile.NamedTemporaryFile(dir=dirname, delete=False) as fo:
+            fo.write(data)
+        os.chmod(fo.name, 0o644)
+        os.replace(fo.name, path)
+        return
+
+    tmp_name = name + ".new"
+    try:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+        try:
+            os.remove(tmp_name, dir_fd=dir_fd)
+        except FileNotFoundError:
+            pass
+        # os.link only calls linkat(AT_SYMLINK_FOLLOW) when given dir fds
+        os.link(f"/proc/self/fd/{fd}", tmp_name, src_dir_fd=dir_fd,
+                dst_dir_fd=dir_fd, follow_symlinks=True)
+        os.replace(tmp_name, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+    finally:
+        os.close(fd)
+        os.close(dir_fd)
 
 
 def remove_nginx_config_file(domain):
     config_path = os.path.join("/etc/nginx/conf.d", domain + ".conf")
-    if os.path.exists(config_path):
-        os.remove(config_path)
+    for path in (config_path, config_path + ".hash"):
+        if os.path.exists(path):
+            os.remove(path)
 
 
 def fail_with_error_message(msg):
+    """
+    Log the error and exit with status 1.
+
+    The SystemExit also stops the event loop when it is raised inside a
+    task: asyncio.run then cancels the other tasks, nginx is asked to quit
+    and the container exits. A failed certbot run therefore ends the
+    container instead of leaving nginx up without certificates.
+
+    :param msg: string
+    """
     logging.error(msg)
     sys.exit(1)
 
@@ -298,51 +554,64 @@ def parse_environment():
     we only really care if the domain and email exists
     :rtype Config
     """
-    config = Config()
-
     if not os.getenv("DOMAIN"):
         fail_with_error_message("DOMAIN must be passed as an env variable")
 
     if not os.getenv("EMAIL"):
         fail_with_error_message("EMAIL must be passed as an env variable")
 
-    config.set("email", os.getenv("EMAIL"))
-    config.set("domain", os.getenv("DOMAIN"))
-    config.set("server", os.getenv("SERVER", Config.defaults.get("server")))
-    config.set("staging", os.getenv("STAGING", Config.defaults.get("staging")))
-    config.set("debug", os.getenv("DEBUG", Config.defaults.get("debug")))
+    return Config(
+        domain=os.environ["DOMAIN"],
+        email=os.environ["EMAIL"],
+        server=os.getenv("SERVER"),
+        staging=bool(os.getenv("STAGING")),
+        debug=bool(os.getenv("DEBUG")))
 
-    return config
 
+async def wait_for_nginx():
+    await Nginx.started.wait()
 
-def wait_for_nginx():
-    while not Nginx.is_running():
-        pass
 
-
-def obtain_cert(config):
+async def obtain_cert(config):
     """
     Go and get the certificates for LE
     :param config Config
     :return:
     """
     certbot = Certbot(config)
-    wait_for_nginx()
-
-    Nginx.write_proxy_config()
-    certbot.run()
-    Nginx.remove_proxy_config()
+    # the proxy config has been written before nginx was started
+    await wait_for_nginx()
 
-    create_nginx_config_file(certbot.domain)
-    Nginx.reload()
+    await certbot.run()
+    if install_tls_config(certbot.domain):
+        Nginx.reload()
 
     # give nginx a second to reload, todo: use something proper
-    time.sleep(1)
+    await asyncio.sleep(1)
     # signal to the renewer that it can start
-    Certbot.done_lock.release()
+    Certbot.done.set()
 
 
-def run_renewer(config, queue):
+async def run_renew_cmd(cmd, debug):
+    """
+    Run the renewal command. In debug mode its output is forwarded to the
+    log line by line as it arrives, otherwise it is discarded.
+
+    :param cmd: list
+    :param debug: bool
+    :return: int, the return code of the command
+    """
+    if not debug:
+        proc = await Process.start(cmd, stdout=asyncio.subprocess.DEVNULL)
+        return await proc.wait()
+
+    proc = await Process.start(cmd, stdout=asyncio.subprocess.PIPE)
+    async for line in proc.stdout:
+        logging.info("renewer: %s", line.decode().rstrip())
+    return await proc.wait()
+
+
+async def run_renewer(config):
     """
     Nginx must be running
     And certbot cmd must be done by now
@@ -356,81 +625,95 @@ def run_renewer(config, queue):
     currently being held in memory by the Nginx master process then
     will we be allowed.
 
-    :type queue: Queue.Queue
+    The task runs until it is cancelled by main.
+
     :type config: Config
     """
-    wait_for_nginx()
-    Certbot.done_lock.acquire()
+    await Certbot.done.wait()
+    await wait_for_nginx()
     logging.info('starting renewer')
-    time.sleep(2)  # not in a rush
+    await asyncio.sleep(2)  # not in a rush
     while 1:
         # try and renew right away - to see if anything will go wrong.
         logging.info('starting renewal process - disallow nginx start')
-        Nginx.disallow_start()  # Nginx is locked and won't restart
+        await Nginx.disallow_start()  # Nginx is locked and won't restart
         remove_nginx_config_file(config.domain)  # remove it first
         Nginx.write_proxy_config()
+        cmd = NGINX_FORCE_RENEW_CMD if config.debug else NGINX_RENEW_CMD
         try:
-            if config.debug:
-                subprocess.check_call(NGINX_FORCE_RENEW_CMD, shell=True)
-            else:
-                subprocess.check_call(NGINX_RENEW_CMD, shell=True)
-        except subprocess.CalledProcessError as perr:
-            logging.debug("renewer: error renewing certificate: %s", perr)
+            retcode = await run_renew_cmd(cmd, config.debug)
+            if retcode != 0:
+                logging.debug(
+                    "renewer: error renewing certificate: exit status %d",
+                    retcode)
         finally:
-            Nginx.remove_proxy_config()
-            create_nginx_config_file(config.domain)
+            install_tls_config(config.domain)
             logging.info('ending renewal process - allow nginx start')
             Nginx.allow_start()
-            for i in range(1800):
-                try:
-                    queue.get(block=True, timeout=2)
-                except Queue.Empty:
-                    pass
-                else:
-                    # thread exits cleanly upon receiving an item for the queue
-                    logging.debug('renewer: whoa! it\'s time to stop')
-                    return
+        try:
+            await asyncio.sleep(RENEW_INTERVAL)
+        except asyncio.CancelledError:
+            logging.debug('renewer: whoa! it\'s time to stop')
+            raise
 
 
-def sigterm_handler():
-    logging.debug('agressive! SIGTERM received')
-    sys.exit(0)
+def shutdown(signum, tasks):
+    """
+    Signal handler: forward the shutdown to nginx so it can drain its
+    connections, and stop the certbot tasks. main finishes once nginx
+    has exited.
 
+    :param signum: int
+    :param tasks: list of asyncio.Task
+    """
+    logging.debug(f"{signal.Signals(signum).name} received, shutting down")
+    Nginx.exit()
+    for task in tasks:
+        task.cancel()
 
-def main():
+
+async def amain():
     config = parse_environment()
-    domain = config.get("domain")
+    domain = config.domain
 
-    # todo: remove this lock
-    Certbot.done_lock.acquire()
+    # run renewal loop as a task
+    tasks = [asyncio.create_task(run_renewer(config))]
 
-    exiting = Queue.Queue(maxsize=1)
-    signal.signal(signal.SIGTERM, sigterm_handler)
-    # run renewal loop in a thread
-    renewer = threading.Thread(target=run_renewer, args=(config, exiting))
-    renewer.start()
+    # we are pid 1 in the container and nginx runs in its own session, so
+    # docker stop and Ctrl-C have to be forwarded
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, shutdown, signum, tasks)
 
     # Case 1: we don't have a certificate yet
-    # write the proxy config and then run certbot. note that the thread will
-    # wait for nginx to start before it starts up.
+    # write the proxy config so nginx starts with it, then run certbot. note
+    # that the task will wait for nginx to start before it starts up.
     # certbot is only ran under the circumstance that the certificates dont
     # already exist
-    if certs_exist(domain):
-        threading.Thread(target=obtain_cert, args=(config,)).start()
+    if certs_missing(domain):
+        Nginx.write_proxy_config()
+        tasks.append(asyncio.create_task(obtain_cert(config)))
 
     # Case 2: we already have a certificate
     # nginx runs forever, what about the case where we have a certificate
-    # but its expired... release the certbot done lock because we never actually
+    # but its expired... set the certbot done event because we never actually
     # ran it.
     else:
         logging.info('we already have the existing certificates')
         create_nginx_config_file(domain)
-        Certbot.done_lock.release()
-
-    Nginx.run_forever()
-    exiting.put(True)
-    renewer.join()
+        Certbot.done.set()
+
+    await Nginx.run_forever()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    # a renewal may have been interrupted half way
+    await Process.kill_all()
     logging.debug('exiting')
 
+
+def main():
+    asyncio.run(amain())
+
 if __name__ == "__main__":
     main()
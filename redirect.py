@@ -1,8 +1,8 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 import atexit
-import BaseHTTPServer
-import SocketServer
+import http.server
+import socketserver
 server = None
 port = 5002
 host = '0.0.0.0'
@@ -14,20 +14,20 @@ def shutdown():
 atexit.register(shutdown)
 
 
-class RedirectHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+class RedirectHandler(http.server.BaseHTTPRequestHandler):
     def do_GET(self):
-        print 'incoming...'
-        rhost = self.headers.getheader('Host')
+        print('incoming...')
+        rhost = self.headers.get('Host')
         rhost = rhost.split(':')[0]
-        location = 'https://{0}{1}'.format(rhost, self.path)
-        print 'redirecting to ' + location
+        location = f'https://{rhost}{self.path}'
+        print('redirecting to ' + location)
         self.send_response(301)
         self.send_header('Location', location)
         self.end_headers()
 
 if __name__ == "__main__":
-    server = SocketServer.TCPServer((host, port), RedirectHandler)
+    server = socketserver.TCPServer((host, port), RedirectHandler)
     server.allow_reuse_address = True
-    print 'starting http -> https redirect server'
+    print('starting http -> https redirect server')
     server.serve_forever()
     server.server_close()
@@ -35,7 +35,7 @@ function killPort {
 redirect_pid=
 function start_redirect {
     killPort 5002
-    python redirect.py &
+    python3 redirect.py &
     redirect_pid=$!
 }
 